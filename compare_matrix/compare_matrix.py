@@ -4,25 +4,94 @@ from __future__ import print_function
 import sys
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError: # numba is optional, Matrix.join falls back to numpy indexing
+    njit = None
+    prange = range
+
+# Columns of the difference table, in output order
+DIFF_FIELDS = ("id1", "id2", "val1", "val2", "diff")
+
 def field_striper(one_field):
     """Return the unique identifier (md5sum) from a label."""
-    return one_field.split('_')[-1] # Unique identifier is after the last _
+    # Unique identifier is after the last _ (whole label if there is none),
+    # sliced out without building the list of all parts
+    return one_field[one_field.rfind('_') + 1:]
 
 
-def sort_output(total_diff_list):
-    """Take an output array made from join and return
-    a view of the sorted one with descending difference.
+def sort_output(total_diff_list, top_k=None):
+    """Take the dictionary of parallel column arrays (keyed by DIFF_FIELDS)
+    made from join and return a new one with the rows sorted by descending difference.
+    If top_k is given, only the top_k highest differences are kept.
+    """
+    # Sorting on the negated diff gives the descending order in one pass,
+    # without a reversed (negative stride) view of the result.
+    # Only the diff column is sorted, the others follow the same index list.
+    if top_k is not None and top_k < 0:
+        raise ValueError("top_k must be positive or zero, got {}".format(top_k))
+    negated_diff = -total_diff_list["diff"]
+    if top_k is not None and top_k < len(negated_diff):
+        # Linear time selection of the top_k, only those are sorted.
+        # The selection comes out scrambled, it is put back in the original order
+        # so tied differences keep it, as with the full stable sort.
+        index_list = np.argpartition(negated_diff, max(top_k - 1, 0))[:top_k]
+        index_list.sort()
+        index_list = index_list[np.argsort(negated_diff[index_list], kind="stable")]
+    else:
+        index_list = np.argsort(negated_diff, kind="stable")
+    return {field: total_diff_list[field][index_list] for field in DIFF_FIELDS}
+
+
+def write_lines(output, columns, separator, block_size=65536):
+    """Write to the opened output one line per element of the columns,
+    the elements of a line joined with the separator.
     """
-    # sorts with the fifth column
-    # argsort() returns a list of index
-    index_list = total_diff_list[:, 4].argsort()
-    sorted_array = total_diff_list[index_list]
-    return sorted_array[::-1]
+    # Lines are formatted and written by blocks, the whole text is never in memory.
+    # Each column of a block is converted to strings by numpy.
+    for start in range(0, len(columns[0]), block_size):
+        block = [column[start:start+block_size].astype('U').tolist() for column in columns]
+        output.write(''.join(separator.join(row) + '\n' for row in zip(*block)))
 
 
 def write_diff_file(diff_matrix, name_output):
     """Write the result of matrix join in the desired format."""
-    np.savetxt(name_output, diff_matrix, fmt='%s') # Here spaces will separate elements
+    columns = [diff_matrix[field] for field in DIFF_FIELDS]
+    with open(name_output, 'w') as output:
+        write_lines(output, columns, ' ') # Here spaces will separate elements
+
+
+def _tri_index(line, column, n):
+    """Return the position of (line, column) in the upper triangle (with diagonal)
+    of a symetric n x n matrix packed line by line.
+    """
+    # The matrix is symetric, (line, column) and (column, line) are the same value
+    i = np.minimum(line, column)
+    j = np.maximum(line, column)
+    # Line i starts after the i previous lines of n, n-1, ..., n-i+1 values
+    return i * (2 * n - i + 1) // 2 + (j - i)
+
+
+def _pair_diff(tri1, n1, tri2, n2, idx1, idx2, val1, val2, diff):
+    """Fill val1, val2 and diff with the values of each non redundant pair of indexes
+    in both packed matrix and their absolute difference, in the upper triangle order
+    of np.triu_indices.
+    """
+    n = len(idx1)
+    for i in prange(n):
+        # Number of pairs in the lines before i, no counter shared between threads
+        base = i * (2 * n - i - 1) // 2
+        for j in range(i + 1, n):
+            k = base + j - i - 1
+            value1 = tri1[_tri_index(idx1[i], idx1[j], n1)]
+            value2 = tri2[_tri_index(idx2[i], idx2[j], n2)]
+            val1[k] = value1
+            val2[k] = value2
+            diff[k] = abs(value2 - value1)
+
+if njit is not None:
+    _tri_index = njit(cache=True)(_tri_index)
+    _pair_diff = njit(parallel=True, fastmath=True, cache=True)(_pair_diff)
 
 
 class Matrix(object):
@@ -45,19 +114,24 @@ class Matrix(object):
 
     Attributes:
         header : A numpy list of the headers with unique identifiers
-        matrix : The numbers (data other than first column and line) as a numpy matrix
+        header_arr : The header as a numpy array of strings as wide as the longest identifier
+        header_order : The index array sorting header_arr
+        tri : The upper triangle, with diagonal, of the numbers (data other than
+              first column and line) packed line by line in a one dimension numpy array
         dico : A dictionary mapping each header field to its position index (row/column)"""
 
     def __init__(self, matrix_file):
         self.header = []
-        self.matrix = None
+        self.header_arr = None
+        self.header_order = None
+        self.tri = None
         self.dico = {}
         self.parse_file(matrix_file)
 
 
     def parse_file(self, matrix_file):
         """Call parse_header and parse_matrix method
-        to fill the header and matrix attributes.
+        to fill the header and tri attributes.
         """
         self.parse_header(matrix_file.readline())
         # Readline is used to read the first line of matrix_file as a string
@@ -74,71 +148,126 @@ class Matrix(object):
         fields = header.strip().split('\t')
         # strip removes all white space on each side of the string (which strips off the first tab)
         # split creates a list of all strings separated by a tab
-        for column_position, field in enumerate(fields):
-            good_field = field_striper(field)
-            self.header.append(good_field)
-            self.dico[good_field] = column_position
+        self.header = [field_striper(field) for field in fields]
+        self.dico = {good_field: column_position
+                     for column_position, good_field in enumerate(self.header)}
+        # Width of the longest identifier (32 for md5sums), never truncated
+        self.header_arr = np.asarray(self.header, dtype='U')
+        # Sorted once, used to search identifiers in this header
+        self.header_order = np.argsort(self.header_arr, kind="stable")
 
 
     def parse_matrix(self, matrix_file):
-        """Read the matrix numeric values into a numpy matrix
-        (skipping the first column) and assign to the matrix attribute.
+        """Read the matrix numeric values (skipping the first column) and assign
+        their upper triangle, packed in a numpy array, to the tri attribute.
+        Every field must hold a number, an empty field raises a ValueError
+        (it is not read as nan).
         """
         # First line already skipped with readline executed before
-        self.matrix = np.genfromtxt(matrix_file, delimiter="\t",
-                                    usecols=range(1, len(self.header)+1))
+        # float32 matches the precision of the diff output and halves the memory
+        matrix = np.loadtxt(matrix_file, delimiter="\t", dtype=np.float32,
+                            usecols=range(1, len(self.header)+1), ndmin=2)
+        # The matrix is symetric, only half of it is kept,
+        # copied line by line to avoid any n x n temporary array
+        n = len(matrix)
+        self.tri = np.empty(n * (n + 1) // 2, dtype=matrix.dtype)
+        start = 0
+        for i in range(n):
+            self.tri[start:start + n - i] = matrix[i, i:]
+            start += n - i
+
+
+    def get_pairs(self, lines, columns, out=None):
+        """Return the values at the (line, column) positions given
+        by the two index arrays, from the packed upper triangle.
+        If out is given the values are written to it and it is returned.
+        """
+        return self.tri.take(_tri_index(lines, columns, len(self.header)), out=out)
 
 
     def common_fields(self, matrix2):
         """Create a list of all common fields and returns it"""
-        return [field for field in self.header if field in matrix2.dico]
+        idx1, _ = self.common_indexes(matrix2)
+        return self.header_arr[idx1].tolist()
 
 
-    def join(self, matrix2):
-        """Return a numpy array with the format [ [field1, field2, val1, val2, diff], [...], ...] which
-        lists off the difference between data from the two entry matrix, for the common fields.
+    def common_indexes(self, matrix2):
+        """Return two index arrays with the respective line/column of each
+        common field in each matrix, in the order of this header.
         """
-        common_identifiers = self.common_fields(matrix2)
-
-        total_diff_list = []  # all of the data to write the final diffence file
-
-        # The matrix are symetric, we use counters to not go over the same elements
-        for counter1, identifier1 in enumerate(common_identifiers):
-
-            col1 = self.dico[identifier1]
-            col2 = matrix2.dico[identifier1]
-            # The respective column of the identifer in each matrix
-
-            for counter2, identifier2 in enumerate(common_identifiers):
+        # Binary search of every identifier in the sorted header of matrix2
+        sorted_header2 = matrix2.header_arr[matrix2.header_order]
+        positions = np.searchsorted(sorted_header2, self.header_arr)
+        positions = np.minimum(positions, len(sorted_header2) - 1)
+        found = sorted_header2[positions] == self.header_arr
+        # Keep the header order so the output is reproducible
+        idx1 = np.flatnonzero(found)
+        idx2 = matrix2.header_order[positions[found]]
+        return idx1, idx2
 
-                if counter2 > counter1:
-                # Don't calculate for the same identifier or the permutation of two identifiers
 
-                    line1 = self.dico[identifier2]
-                    line2 = matrix2.dico[identifier2]
-                    # The respective line of the identifer in each matrix
-                    # line and column coulb be inverted, the matrix are symetric
-
-                    value1 = self.matrix[line1, col1]
-                    value2 = matrix2.matrix[line2, col2]
-                    diff = abs(value2 - value1)
-
-                    total_diff_list.append([identifier1, identifier2, value1, value2, diff])
-
-        return np.array(total_diff_list)
+    def join(self, matrix2):
+        """Return a dictionary of parallel numpy arrays with the keys (id1, id2, val1, val2, diff)
+        which lists off the difference between data from the two entry matrix, for the common fields.
+        """
+        # The respective line/column of each common identifier in each matrix
+        idx1, idx2 = self.common_indexes(matrix2)
+
+        # The matrix are symetric, the upper triangle (without diagonal)
+        # holds every non redundant pair of identifiers
+        n = len(idx1)
+        n_pairs = n * (n - 1) // 2
+
+        # Fixed width strings copied by numpy, no python string per pair
+        identifiers = self.header_arr[idx1]
+
+        # The whole output is allocated once, one contiguous array per column
+        # instead of one record per pair, then filled column by column
+        total_diff_list = {"id1": np.empty(n_pairs, dtype=identifiers.dtype),
+                           "id2": np.empty(n_pairs, dtype=identifiers.dtype),
+                           "val1": np.empty(n_pairs, dtype=np.float32),
+                           "val2": np.empty(n_pairs, dtype=np.float32),
+                           "diff": np.empty(n_pairs, dtype=np.float32)}
+        val1 = total_diff_list["val1"]
+        val2 = total_diff_list["val2"]
+        diff = total_diff_list["diff"]
+
+        # Line i of the upper triangle pairs identifier i with every identifier after it,
+        # the columns are filled line by line without any index array per pair
+        id1 = total_diff_list["id1"]
+        id2 = total_diff_list["id2"]
+        base = 0
+        for i in range(n):
+            end = base + n - i - 1
+            id1[base:end] = identifiers[i]
+            id2[base:end] = identifiers[i+1:]
+            if njit is None:
+                # One take per matrix for the values of the line
+                self.get_pairs(idx1[i], idx1[i+1:], out=val1[base:end])
+                matrix2.get_pairs(idx2[i], idx2[i+1:], out=val2[base:end])
+            base = end
+
+        if njit is not None:
+            # Reads only the needed pairs, without building index arrays
+            _pair_diff(self.tri, len(self.header), matrix2.tri, len(matrix2.header),
+                       idx1, idx2, val1, val2, diff)
+        else:
+            # Subtraction and absolute value in the same buffer, no temporary array
+            np.subtract(val2, val1, out=diff)
+            np.fabs(diff, out=diff)
+
+        return total_diff_list
 
 
     def print_pairings(self):
         """Print non redundant correlation pairings."""
-        sorted_md5s = sorted(self.header)
-        for i, md5_1 in enumerate(sorted_md5s):
-            line = self.dico[md5_1]
-            for j, md5_2 in enumerate(sorted_md5s):
-                if j > i:
-                    col = self.dico[md5_2]
-                    value = self.matrix[line, col]
-                    s = "{}\t{}\t{}".format(md5_1, md5_2, value)
-                    print(s)
+        # Every pair of sorted identifiers, the first one sorting before the second.
+        # Written one identifier at a time, the pairs are never all in memory.
+        for i, line in enumerate(self.header_order):
+            columns = self.header_order[i+1:]
+            values = self.get_pairs(line, columns)
+            first = np.repeat(self.header_arr[line:line+1], len(columns))
+            write_lines(sys.stdout, [first, self.header_arr[columns], values], '\t')
 
 
 def main():
@@ -146,14 +275,16 @@ def main():
     to find what data is different for the same combination of fields,
     sort them with the highest difference at the top
     and then we write a file containing all those differences
+    (or only the highest ones if a number is given as fourth argument)
     """
     output_name = sys.argv[3]
+    top_k = int(sys.argv[4]) if len(sys.argv) > 4 else None
 
     with open(sys.argv[1], 'r') as file1, open(sys.argv[2], 'r') as file2:
         matrix1, matrix2 = Matrix(file1), Matrix(file2)
 
     diff_list = matrix1.join(matrix2)
-    sorted_diff_list = sort_output(diff_list)
+    sorted_diff_list = sort_output(diff_list, top_k)
     write_diff_file(sorted_diff_list, output_name)
 
 
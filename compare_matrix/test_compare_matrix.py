@@ -0,0 +1,117 @@
+"""Regression checks of the packed triangle and of Matrix.join against the
+original per pair loop, with and without numba."""
+import io
+
+import numpy as np
+import pytest
+
+import compare_matrix
+
+
+def make_matrix_file(labels, seed):
+    """Return a GeEC matrix file of random symetric values for the labels,
+    and the values as read back in float32.
+    """
+    rng = np.random.RandomState(seed)
+    n = len(labels)
+    values = rng.uniform(-1, 1, (n, n))
+    values = np.round((values + values.T) / 2, 4)
+    np.fill_diagonal(values, 1)
+    lines = ['\t' + '\t'.join(labels)]
+    for label, row in zip(labels, values):
+        lines.append(label + '\t' + '\t'.join('%.4f' % value for value in row))
+    text = '\n'.join(lines) + '\n'
+    full = np.loadtxt(io.StringIO(text), delimiter='\t', dtype=np.float32,
+                      skiprows=1, usecols=range(1, n + 1), ndmin=2)
+    return io.StringIO(text), full
+
+
+def baseline_join(matrix1, full1, matrix2, full2):
+    """The per pair loop Matrix.join replaced, on the full matrices."""
+    common = [field for field in matrix1.header if field in matrix2.dico]
+    rows = []
+    for counter1, identifier1 in enumerate(common):
+        col1 = matrix1.dico[identifier1]
+        col2 = matrix2.dico[identifier1]
+        for counter2, identifier2 in enumerate(common):
+            if counter2 > counter1:
+                value1 = full1[matrix1.dico[identifier2], col1]
+                value2 = full2[matrix2.dico[identifier2], col2]
+                rows.append((identifier1, identifier2, value1, value2, abs(value2 - value1)))
+    return rows
+
+
+@pytest.fixture
+def matrices():
+    md5s = ['%032x' % (i * 7919) for i in range(12)]
+    labels1 = ['a%d_x_%s' % (i, md5) for i, md5 in enumerate(md5s[:9])]
+    # Partial overlap, in a different order and with other label prefixes
+    labels2 = ['b%d_%s' % (i, md5) for i, md5 in enumerate(md5s[3:])]
+    labels2 = [labels2[i] for i in [4, 0, 7, 2, 8, 1, 5, 3, 6]]
+    file1, full1 = make_matrix_file(labels1, 1)
+    file2, full2 = make_matrix_file(labels2, 2)
+    return compare_matrix.Matrix(file1), full1, compare_matrix.Matrix(file2), full2
+
+
+def test_get_pairs_matches_full_matrix(matrices):
+    matrix1, full1, _, _ = matrices
+    n = len(matrix1.header)
+    lines, columns = np.indices((n, n))
+    assert np.array_equal(matrix1.get_pairs(lines.ravel(), columns.ravel()), full1.ravel())
+
+
+@pytest.mark.parametrize("use_numba", [False, True])
+def test_join_matches_baseline(matrices, use_numba, monkeypatch):
+    if use_numba and compare_matrix.njit is None:
+        pytest.skip("numba is not installed")
+    if not use_numba:
+        monkeypatch.setattr(compare_matrix, "njit", None)
+    matrix1, full1, matrix2, full2 = matrices
+
+    result = matrix1.join(matrix2)
+    rows = list(zip(*(result[field].tolist() for field in compare_matrix.DIFF_FIELDS)))
+
+    expected = baseline_join(matrix1, full1, matrix2, full2)
+    assert len(expected) == 6 * 5 // 2
+    assert rows == [(id1, id2, float(v1), float(v2), float(d)) for id1, id2, v1, v2, d in expected]
+
+
+def test_sort_output_top_k():
+    # Differences with 4 decimals, tied everywhere like the real output
+    rng = np.random.RandomState(3)
+    n_pairs = 500
+    result = {"id1": np.array(['a%d' % i for i in range(n_pairs)]),
+              "id2": np.array(['b%d' % i for i in range(n_pairs)]),
+              "val1": rng.uniform(-1, 1, n_pairs).astype(np.float32),
+              "val2": rng.uniform(-1, 1, n_pairs).astype(np.float32),
+              "diff": (rng.randint(0, 20, n_pairs) / 1e4).astype(np.float32)}
+    full = compare_matrix.sort_output(result)
+    assert np.all(np.diff(full["diff"]) <= 0)
+
+    # Ends of the groups of tied differences, where top_k cuts no group
+    group_ends = np.flatnonzero(np.diff(full["diff"])) + 1
+    for top_k in [0, 1, 7, 100, 333] + group_ends[:5].tolist() + [n_pairs, 1000]:
+        top = compare_matrix.sort_output(result, top_k)
+        assert np.array_equal(top["diff"], full["diff"][:top_k])
+        # Rows are the same as in the full sort, except in the group cut by top_k
+        if top_k in group_ends or top_k >= n_pairs:
+            same = top_k
+        else:
+            same = np.count_nonzero(full["diff"][:top_k] > full["diff"][top_k - 1])
+        for field in compare_matrix.DIFF_FIELDS:
+            assert np.array_equal(top[field][:same], full[field][:same])
+
+    with pytest.raises(ValueError):
+        compare_matrix.sort_output(result, -1)
+
+
+def test_print_pairings_matches_baseline(matrices, capsys):
+    matrix1, full1, _, _ = matrices
+    matrix1.print_pairings()
+    printed = [line.split('\t') for line in capsys.readouterr().out.splitlines()]
+
+    sorted_md5s = sorted(matrix1.header)
+    expected = [(md5_1, md5_2, full1[matrix1.dico[md5_1], matrix1.dico[md5_2]])
+                for i, md5_1 in enumerate(sorted_md5s)
+                for md5_2 in sorted_md5s[i+1:]]
+    assert [(md5_1, md5_2, np.float32(value)) for md5_1, md5_2, value in printed] == expected